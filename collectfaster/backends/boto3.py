@@ -1,10 +1,206 @@
 # -*- coding: utf-8 -*-
+import os
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+
+from boto3.s3.transfer import TransferConfig
+from botocore.compat import HAS_CRT
+from botocore.config import Config
 from django.conf import settings
+from django.core.files.base import ContentFile
 from storages.backends.s3boto3 import S3Boto3Storage
+from storages.utils import clean_name
+
+MB = 1024 * 1024
+
+RemoteFile = namedtuple('RemoteFile', 'etag size last_modified')
 
 
 class S3Boto3StaticStorage(S3Boto3Storage):
+    """
+    Static files storage which uploads through boto3's transfer manager, so every file bigger than the multipart
+    threshold is split into chunks that are uploaded concurrently.
+    """
     location = getattr(settings, 'STATICFILES_LOCATION', 'static')
+    multipart_threshold = getattr(settings, 'AWS_S3_MULTIPART_THRESHOLD', 8 * MB)
+    multipart_chunksize = getattr(settings, 'AWS_S3_MULTIPART_CHUNKSIZE', 8 * MB)
+    multipart_concurrency = getattr(settings, 'AWS_S3_MULTIPART_CONCURRENCY', 10)
+    max_pool_connections = getattr(settings, 'AWS_S3_MAX_POOL_CONNECTIONS', 10)
+    tcp_keepalive = getattr(settings, 'AWS_S3_TCP_KEEPALIVE', True)
+    retries = getattr(settings, 'AWS_S3_RETRIES', {'mode': 'adaptive', 'max_attempts': 5})
+    # CRC32C is calculated with hardware instructions by the AWS CRT (`pip install botocore[crt]`), without it CRC32
+    # from zlib is the fastest checksum botocore supports
+    checksum_algorithm = getattr(settings, 'AWS_S3_CHECKSUM_ALGORITHM', 'CRC32C' if HAS_CRT else 'CRC32')
+    # The `content_encoding` of a saved file is uploaded as `Content-Encoding` (see `_get_write_parameters`), which is
+    # required by `collectstatic --faster --precompress`
+    accepts_precompressed_content = True
+
+    def __init__(self, *args, **kwargs):
+        super(S3Boto3StaticStorage, self).__init__(*args, **kwargs)
+        # django-storages always creates a `TransferConfig`, but a configured `AWS_S3_TRANSFER_CONFIG` (or
+        # `transfer_config` argument) wins over the `AWS_S3_MULTIPART_*` settings
+        if kwargs.get('transfer_config') is None and getattr(settings, 'AWS_S3_TRANSFER_CONFIG', None) is None:
+            self.transfer_config = TransferConfig(
+                multipart_threshold=self.multipart_threshold,
+                max_concurrency=self.multipart_concurrency,
+                multipart_chunksize=self.multipart_chunksize,
+                use_threads=getattr(self, 'use_threads', True),
+            )
+        self.remote_files = None
+        self._submit_upload = None
+        # The futures of the deferred uploads by key, see `deferred_uploads`
+        self._pending_uploads = {}
+        # Keep idle connections alive while nothing is uploaded (e.g. during post processing), S3 closes them after 20s.
+        # The options of a configured `AWS_S3_CLIENT_CONFIG` win over these settings.
+        self._merge_config(Config(
+            tcp_keepalive=self.tcp_keepalive,
+            retries=self.retries,
+            max_pool_connections=self.max_pool_connections,
+        ), override=False)
+        # django-storages opens a client per thread (and process), so its pool is only shared by the threads of the
+        # transfer manager, which upload the parts of a big file concurrently. Without enough connections urllib3
+        # discards them and the discarded requests have to do a new TLS handshake.
+        if self.get_max_pool_connections() < self.transfer_config.max_concurrency:
+            self.set_max_pool_connections(self.transfer_config.max_concurrency)
+
+    def get_max_pool_connections(self):
+        """
+        Return the size of the connection pool the botocore client will be created with.
+        """
+        return self.client_config.max_pool_connections
+
+    def set_max_pool_connections(self, amount):
+        """
+        Resize the connection pool of the botocore clients. The clients are created lazily (one per thread), so this
+        has to be called before the storage is used by the workers.
+        """
+        self._merge_config(Config(max_pool_connections=amount))
+
+    def _merge_config(self, config, override=True):
+        """
+        Merge the given botocore config into the one of the storage. Options of the storage's config win if `override`
+        is `False`.
+        """
+        if override:
+            self.client_config = self.client_config.merge(config)
+        else:
+            self.client_config = config.merge(self.client_config)
+
+    def reset_connections(self):
+        """
+        Forget all the opened connections. django-storages keeps one connection per thread, but a forked worker process
+        would otherwise reuse the connection (and the sockets) of its parent process.
+        """
+        self._connections = threading.local()
+        self._bucket = None
+
+    @property
+    def bucket(self):
+        """
+        The super class caches the bucket of the first thread's connection, through which every thread would upload. Keep
+        one bucket per connection instead, so the threads don't share a connection pool.
+        """
+        bucket = getattr(self._connections, 'bucket', None)
+        if bucket is None:
+            bucket = self._connections.bucket = self.connection.Bucket(self.bucket_name)
+        return bucket
+
+    def preload_remote_files(self):
+        """
+        List all the files below `location` with one request per 1000 files and remember their ETag, size and last
+        modification. Afterwards `exists()` is answered from this list instead of sending a HEAD request per file.
+        """
+        remote_files = {}
+        paginator = self.connection.meta.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=self._normalize_name('')):
+            for obj in page.get('Contents', []):
+                remote_files[obj['Key']] = RemoteFile(obj['ETag'].strip('"'), obj['Size'], obj['LastModified'])
+        self.remote_files = remote_files
+
+    def forget_remote_files(self):
+        """
+        Drop the preloaded list, so `exists()` asks S3 again. The list would get stale once the files are changed by
+        someone else (e.g. by another process).
+        """
+        self.remote_files = None
+
+    def add_remote_file(self, name):
+        """
+        Add a saved file to the preloaded list. Its details aren't known without another request, but we know that the
+        file exists now.
+        """
+        if self.remote_files is not None:
+            self.remote_files[self._normalize_name(clean_name(name))] = None
+
+    def get_remote_file(self, name):
+        """
+        Return the preloaded `RemoteFile` or `None` if it is unknown.
+        """
+        if self.remote_files is None:
+            return None
+        return self.remote_files.get(self._normalize_name(clean_name(name)))
+
+    def exists(self, name):
+        if self.remote_files is None:
+            return super(S3Boto3StaticStorage, self).exists(name)
+        return self._normalize_name(clean_name(name)) in self.remote_files
+
+    def delete(self, name):
+        # A deferred upload which finishes after the delete would bring the file back
+        self._wait_for_upload(self._normalize_name(clean_name(name)))
+        super(S3Boto3StaticStorage, self).delete(name)
+        if self.remote_files is not None:
+            self.remote_files.pop(self._normalize_name(clean_name(name)), None)
+
+    def _save(self, name, content):
+        if self._submit_upload is None:
+            name = super(S3Boto3StaticStorage, self)._save(name, content)
+        else:
+            # The caller may close the content as soon as we returned
+            content.seek(0, os.SEEK_SET)
+            deferred_content = ContentFile(content.read())
+            deferred_content.content_type = getattr(content, 'content_type', None)
+            deferred_content.content_encoding = getattr(content, 'content_encoding', None)
+            name = clean_name(name)
+            key = self._normalize_name(name)
+            # An earlier upload of the same file must not finish after this one
+            self._wait_for_upload(key)
+            self._pending_uploads[key] = self._submit_upload(
+                super(S3Boto3StaticStorage, self)._save, name, deferred_content)
+
+        self.add_remote_file(name)
+        return name
+
+    @contextmanager
+    def deferred_uploads(self, submit):
+        """
+        Within this context `_save` doesn't wait for the upload, but passes it to `submit(upload, *args)` (e.g. to run
+        it in a thread pool) and returns immediately. `submit` has to return a future, which `delete` (or saving the
+        same file again) waits for. Used by `collectstatic --faster` to upload the files saved by `post_process` while
+        the next files are post processed.
+        """
+        self._submit_upload = submit
+        try:
+            yield
+        finally:
+            self._submit_upload = None
+            self._pending_uploads = {}
+
+    def _wait_for_upload(self, key):
+        future = self._pending_uploads.pop(key, None)
+        if future is not None:
+            future.result()
+
+    def _get_write_parameters(self, name, content=None):
+        params = super(S3Boto3StaticStorage, self)._get_write_parameters(name, content)
+        # The content may already be compressed (e.g. by `collectstatic --faster --precompress`)
+        content_encoding = getattr(content, 'content_encoding', None)
+        if content_encoding and 'ContentEncoding' not in params:
+            params['ContentEncoding'] = content_encoding
+        if 'ChecksumAlgorithm' not in params and self.checksum_algorithm:
+            params['ChecksumAlgorithm'] = self.checksum_algorithm
+        return params
 
 
 class S3Boto3MediaStorage(S3Boto3Storage):
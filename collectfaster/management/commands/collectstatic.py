@@ -1,57 +1,160 @@
 # -*- coding: utf-8 -*-
+import gzip
+import hashlib
+import itertools
+import mimetypes
 import multiprocessing
+import os
+import sys
+import threading
 import time
 
-from collections import OrderedDict
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from django.contrib.staticfiles.management.commands import collectstatic
-from gevent import joinall, monkey, spawn
-from gevent.queue import Queue as GeventQueue
+from django.core.files.base import ContentFile
+from django.core.management.base import CommandError
+from gevent import monkey
+from gevent.pool import Pool as GeventPool
+
+# Initialize the map of types now instead of doing it in the first worker which calls `guess_type()`
+mimetypes.init()
+
+# A file found by `file_handler`, which is processed by `_do_task`
+Task = namedtuple('Task', 'handler_type path prefixed_path source_storage content_type content_encoding precompress')
+
+# The command instance of a worker process, see `_init_mp_worker`
+_mp_worker_command = None
+
+
+def _init_mp_worker(command):
+    global _mp_worker_command
+    _mp_worker_command = command
+    if hasattr(command.storage, 'reset_connections'):
+        # Each worker process opens its own connection once, which is then reused for all of its tasks
+        command.storage.reset_connections()
+        command.storage.connection
+
+
+def _mp_do_task(task):
+    """
+    Process a task within a worker process. This is a module level function, so the pool only has to pickle the task
+    and not the whole command with all its collected files.
+    """
+    return task.prefixed_path, _mp_worker_command._do_task(task)
 
 
 class Command(collectstatic.Command):
     """
-    This command extends Django's `collectstatic` with a `--faster` argument for parallel file copying using gevent.
-    The speed improvement is especially helpful for remote storage backends like S3.
+    This command extends Django's `collectstatic` with a `--faster` argument for parallel file copying using gevent,
+    threads or processes. The speed improvement is especially helpful for remote storage backends like S3.
     """
     def __init__(self, *args, **kwargs):
         super(Command, self).__init__(*args, **kwargs)
         self.counter = 0
+        # `next()` of a count is atomic, `self.counter += 1` isn't when called by multiple threads. The total is read
+        # once after all the workers finished (see `handle`).
+        self._counter_it = itertools.count()
         self.task_queue = None
+        self.enqueue_method = None
         self.worker_spawn_method = None
-        self.use_multiprocessing = False
-        self.found_files = OrderedDict()
+        self.thread_pool = None
+        self.in_flight = None
+        self.task_errors = []
+        self.executor = None
+        self.found_files = {}
 
     def add_arguments(self, parser):
         super(Command, self).add_arguments(parser)
         parser.add_argument('--faster', action='store_true', default=False, help='Collect static files simultaneously')
         parser.add_argument('--workers', action='store', default=20, help='Amount of simultaneous workers (default=20)')
-        parser.add_argument('--use-multiprocessing', action='store_true', default=False, help='Use multiprocessing library instead of gevent')
+        parser.add_argument('--executor', action='store', default=None, choices=['gevent', 'threadpool', 'multiprocessing'],
+                            help='Spawn the workers as greenlets, threads or processes (default=threadpool for boto3 '
+                                 'storages, gevent otherwise)')
+        parser.add_argument('--trust-mtime', action='store_true', default=False,
+                            help='Skip files if the remote file has the same size and is newer than the local file')
+        parser.add_argument('--precompress', action='store_true', default=False,
+                            help='Gzip text files while collecting them and upload them with `Content-Encoding: gzip`')
+        parser.add_argument('--use-multiprocessing', action='store_true', default=False,
+                            help='Use multiprocessing library instead of gevent (same as --executor=multiprocessing)')
 
     def set_options(self, **options):
         self.faster = options.pop('faster')
         self.queue_worker_amount = int(options.pop('workers'))
-        self.use_multiprocessing = options.pop('use_multiprocessing')
-
-        if self.use_multiprocessing:
-            self.task_queue = multiprocessing.JoinableQueue()
-            self.worker_spawn_method = self.mp_spawn
-        else:
-            self.task_queue = GeventQueue()
-            self.worker_spawn_method = self.gevent_spawn
-
+        self.executor = options.pop('executor')
+        self.trust_mtime = options.pop('trust_mtime')
+        self.precompress = options.pop('precompress')
+        use_multiprocessing = options.pop('use_multiprocessing')
         super(Command, self).set_options(**options)
 
         if self.faster:
+            self.set_executor(use_multiprocessing)
+
             # The original management command of Django collects all the files and calls the post_process method of
             # the storage backend within the same method. Because we are using a task queue, post processing is started
             # before all files were collected.
             self.post_process_original = self.post_process
             self.post_process = False
 
+        if self.precompress and not self.faster:
+            raise CommandError('--precompress can only be used together with --faster.')
+        if self.precompress and not getattr(self.storage, 'accepts_precompressed_content', False):
+            # Other storages would save the compressed content without setting a `Content-Encoding`
+            raise CommandError('--precompress is only supported by storages based on '
+                               '`collectfaster.backends.boto3.S3Boto3StaticStorage`.')
+
+    def set_executor(self, use_multiprocessing):
+        """
+        Choose how the workers are spawned. This is only done for `--faster`, because gevent patches the whole process
+        for good, which would also affect any later command running in the same process.
+        """
+        if use_multiprocessing:
+            self.executor = 'multiprocessing'
+        elif self.executor is None:
+            # boto3 uploads with its own threads, which hang on sockets that were monkey patched by gevent
+            self.executor = 'threadpool' if self.storage_uses_boto3() else 'gevent'
+        elif self.executor == 'gevent' and self.storage_uses_boto3():
+            # boto3 already imported `ssl`, patching it now breaks (or hangs) every new connection
+            raise CommandError('--executor=gevent is not supported by boto3 storages, '
+                               'use --executor=threadpool or multiprocessing.')
+
+        if self.executor == 'multiprocessing':
+            self.task_queue = deque()
+            self.enqueue_method = self.task_queue.append
+            self.worker_spawn_method = self.mp_spawn
+        elif self.executor == 'threadpool':
+            # The threads are working while the files are still being collected, so there is no queue to fill up.
+            self.enqueue_method = self.threadpool_submit
+            self.worker_spawn_method = self.threadpool_join
+        else:
+            if not self.dry_run:
+                # Patch as early as possible, patching after connections were opened can make them hang. A dry run
+                # doesn't spawn any workers, so there is no need to patch anything.
+                monkey.patch_all(thread=False)
+            self.task_queue = deque()
+            self.enqueue_method = self.task_queue.append
+            self.worker_spawn_method = self.gevent_spawn
+
+    def storage_uses_boto3(self):
+        """
+        Check if the storage backend is based on django-storages' `S3Boto3Storage`. We don't want to import boto3 (and
+        with it `ssl`) just for this check if the storage doesn't use it, because gevent has to patch `ssl` before.
+        """
+        storage_class = self.storage.__class__
+        if 'boto3' not in sys.modules:
+            return False
+        from storages.backends.s3boto3 import S3Boto3Storage
+        return issubclass(storage_class, S3Boto3Storage)
+
     def handle(self, **options):
         start_time = time.time()
         super(Command, self).handle(**options)
-        self.log('%s static files copied asynchronously in %is.' % (self.counter, time.time() - start_time), level=1)
+        self.counter = next(self._counter_it)
+        if self.dry_run:
+            self.log('%s static files would have been copied.' % self.counter, level=1)
+        else:
+            self.log('%s static files copied asynchronously in %is.' % (self.counter, time.time() - start_time), level=1)
 
     def copy_file(self, path, prefixed_path, source_storage):
         self.file_handler('copy', path, prefixed_path, source_storage)
@@ -61,20 +164,33 @@ class Command(collectstatic.Command):
 
     def file_handler(self, handler_type, path, prefixed_path, source_storage):
         """
-        Create a dict with all kwargs of the `copy_file` or `link_file` method of the super class and add it to
-        the queue for later processing.
+        Create a `Task` with all arguments of the `copy_file` or `link_file` method of the super class and add it to
+        the queue (or pass it to a worker thread) for later processing.
         """
         if self.faster:
-            if prefixed_path not in self.found_files:
-                self.found_files[prefixed_path] = (source_storage, path)
-
-            self.task_queue.put({
-                'handler_type': handler_type,
-                'path': path,
-                'prefixed_path': prefixed_path,
-                'source_storage': source_storage
-            })
-            self.counter += 1
+            self.found_files.setdefault(prefixed_path, (source_storage, path))
+
+            # Guess the type once here instead of letting the storage of every worker do it
+            content_type, content_encoding = mimetypes.guess_type(prefixed_path)
+            precompress = self.precompress and not self.dry_run and handler_type == 'copy' and \
+                content_encoding is None and content_type in self.storage.gzip_content_types
+            if precompress:
+                # The file is compressed by the worker right before it is uploaded (see `_do_task`)
+                content_encoding = 'gzip'
+
+            # The remote size of a precompressed file is its compressed size, it can't be compared with the local file
+            if self.trust_mtime and handler_type == 'copy' and not precompress and \
+                    self.is_up_to_date(path, prefixed_path, source_storage):
+                self.log("Skipping '%s' (not modified)" % path)
+                self.unmodified_files.append(prefixed_path)
+                return
+
+            task = Task(handler_type, path, prefixed_path, source_storage, content_type, content_encoding, precompress)
+            if self.dry_run:
+                # Nothing is copied, so it isn't worth to start any workers
+                self._do_task(task)
+            else:
+                self.enqueue_method(task)
         else:
             if handler_type == 'link':
                 super(Command, self).link_file(path, prefixed_path, source_storage)
@@ -92,73 +208,223 @@ class Command(collectstatic.Command):
 
     def collect(self):
         """
-        Create some concurrent workers that process the tasks simultaneously.
+        Create some concurrent workers that process the tasks simultaneously (or wait for the worker threads which
+        already started during the collection).
         """
-        collected = super(Command, self).collect()
-        if self.faster:
-            self.worker_spawn_method()
-            self.post_processor()
+        if self.faster and hasattr(self.storage, 'preload_remote_files'):
+            # Load the list of existing files at once instead of checking each file separately
+            self.storage.preload_remote_files()
+
+        try:
+            collected = super(Command, self).collect()
+            if self.faster:
+                if not self.dry_run:
+                    self.worker_spawn_method()
+                self.post_processor()
+        finally:
+            # The storage outlives the command, don't let it answer from a list which gets stale
+            if self.faster and hasattr(self.storage, 'forget_remote_files'):
+                self.storage.forget_remote_files()
         return collected
 
     def post_processor(self):
         # Here we check if the storage backend has a post_process
         # method and pass it the list of modified files.
         if self.post_process_original and hasattr(self.storage, 'post_process'):
-            processor = self.storage.post_process(self.found_files,
-                                                  dry_run=self.dry_run)
-            for original_path, processed_path, processed in processor:
-                if isinstance(processed, Exception):
-                    self.stderr.write("Post-processing '%s' failed!" % original_path)
-                    # Add a blank line before the traceback, otherwise it's
-                    # too easy to miss the relevant part of the error message.
-                    self.stderr.write("")
-                    raise processed
-                if processed:
-                    self.log("Post-processed '%s' as '%s'" %
-                             (original_path, processed_path), level=1)
-                    self.post_processed_files.append(original_path)
-                else:
-                    self.log("Skipped post-processing '%s'" % original_path)
+            if self.executor == 'threadpool' and not self.dry_run and hasattr(self.storage, 'deferred_uploads'):
+                # Post processing has to wait until all the files were copied, because e.g. `ManifestFilesMixin` reads
+                # referenced files from the storage. But the post processed files can be uploaded by the worker
+                # threads while the next files are post processed.
+                with self.storage.deferred_uploads(self._threadpool_submit):
+                    self._post_process()
+                self.threadpool_join()
+            else:
+                self._post_process()
+
+    def _post_process(self):
+        processor = self.storage.post_process(self.found_files,
+                                              dry_run=self.dry_run)
+        for original_path, processed_path, processed in processor:
+            if isinstance(processed, Exception):
+                self.stderr.write("Post-processing '%s' failed!" % original_path)
+                # Add a blank line before the traceback, otherwise it's
+                # too easy to miss the relevant part of the error message.
+                self.stderr.write("")
+                raise processed
+            if processed:
+                self.log("Post-processed '%s' as '%s'" %
+                         (original_path, processed_path), level=1)
+                self.post_processed_files.append(original_path)
+            else:
+                self.log("Skipped post-processing '%s'" % original_path)
 
     def gevent_spawn(self):
-        """ Spawn worker threads (using gevent) """
-        monkey.patch_all(thread=False)
-        joinall([spawn(self.gevent_worker) for x in range(self.queue_worker_amount)])
+        """
+        Spawn worker threads (using gevent). The pool runs at most `--workers` greenlets at the same time and starts a
+        new one for the next task as soon as one finished.
+        """
+        pool = GeventPool(self.queue_worker_amount)
+        for x in pool.imap_unordered(self._do_task, self.iter_tasks()):
+            pass
+        pool.join()
 
-    def gevent_worker(self):
+    def iter_tasks(self):
         """
-        Process one task after another by calling the handler (`copy_file` or `copy_link`) method of the super class.
+        Remove the queued tasks one by one. All of them were queued before the workers are spawned, so there is no
+        need for a synchronized queue and each task can be freed as soon as it was processed.
         """
-        while not self.task_queue.empty():
-            task_kwargs = self.task_queue.get()
-            handler_type = task_kwargs.pop('handler_type')
+        while True:
+            try:
+                yield self.task_queue.popleft()
+            except IndexError:
+                return
 
-            if handler_type == 'link':
-                super(Command, self).link_file(**task_kwargs)
-            else:
-                super(Command, self).copy_file(**task_kwargs)
+    def threadpool_submit(self, task):
+        """
+        Pass the task to a worker thread (using concurrent.futures) as soon as it was found, so copying overlaps with
+        collecting the remaining files. Unlike gevent this doesn't need any monkey patching, which conflicts with the
+        threads boto3 uses for its own transfers.
+        """
+        self._threadpool_submit(self._do_task, task)
+
+    def _threadpool_submit(self, fn, *args):
+        if self.thread_pool is None:
+            self.thread_pool = ThreadPoolExecutor(max_workers=self.queue_worker_amount)
+            # Don't buffer more pending tasks than needed to keep all the workers busy
+            self.in_flight = threading.BoundedSemaphore(2 * self.queue_worker_amount)
+        if self.task_errors:
+            raise self.task_errors[0]
+
+        self.in_flight.acquire()
+        future = self.thread_pool.submit(fn, *args)
+        future.add_done_callback(self._threadpool_task_done)
+        return future
+
+    def _threadpool_task_done(self, future):
+        if future.exception() is not None:
+            self.task_errors.append(future.exception())
+        self.in_flight.release()
+
+    def threadpool_join(self):
+        """ Wait until the worker threads processed all the submitted tasks """
+        if self.thread_pool is not None:
+            self.thread_pool.shutdown(wait=True)
+            self.thread_pool = None
+        if self.task_errors:
+            raise self.task_errors[0]
 
     def mp_spawn(self):
-        """ Spawn worker processes (using multiprocessing) """
-        processes = []
-        for x in range(self.queue_worker_amount):
-            process = multiprocessing.Process(target=self.mp_worker)
-            process.start()
-            processes.append(process)
-        for process in processes:
-            process.join()
+        """
+        Spawn worker processes (using multiprocessing). The tasks are sent to the processes in chunks, which saves a lot
+        of inter-process communication for the many small files of a usual project.
+        """
+        # Forked processes inherit the loaded Django project instead of importing and setting up everything again
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+        else:
+            context = multiprocessing.get_context()
+        pool = context.Pool(self.queue_worker_amount, initializer=_init_mp_worker, initargs=(self,))
+        try:
+            for prefixed_path, copied in pool.imap_unordered(_mp_do_task, self.iter_tasks(), chunksize=16):
+                # The counter and the list of remote files of the worker processes are lost, so we have to update them
+                # here (e.g. post processing checks if the copied files exist)
+                if copied:
+                    next(self._counter_it)
+                    if hasattr(self.storage, 'add_remote_file'):
+                        self.storage.add_remote_file(prefixed_path)
+        except BaseException:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+
+    def _do_task(self, task):
+        """
+        Process a single task by calling the handler (`copy_file` or `copy_link`) method of the super class. Returns
+        `False` if the file was skipped.
+        """
+        if task.handler_type == 'link':
+            super(Command, self).link_file(task.path, task.prefixed_path, task.source_storage)
+        else:
+            # Compress in the worker, so only the files which are currently uploaded are kept in memory. zlib releases
+            # the GIL, so the other threads keep uploading meanwhile.
+            compressed = self.compress_file(task.path, task.source_storage) if task.precompress else None
+            # A dry run doesn't read and hash every file, so it also pretends to copy the unmodified ones
+            if not self.dry_run and \
+                    self.is_unmodified(task.path, task.prefixed_path, task.source_storage, compressed=compressed):
+                self.log("Skipping '%s' (not modified)" % task.path)
+                self.unmodified_files.append(task.prefixed_path)
+                return False
+            self._copy_file(task.path, task.prefixed_path, task.source_storage, task.content_type,
+                            task.content_encoding, compressed)
 
-    def mp_worker(self):
+        next(self._counter_it)
+        return True
+
+    def _copy_file(self, path, prefixed_path, source_storage, content_type, content_encoding, compressed):
         """
-        Process one task after another by calling the handler (`copy_file` or `copy_link`) method of the super class.
+        Same as `copy_file` of the super class, but passes the content type which was guessed by `file_handler` to the
+        storage and saves the precompressed content instead of the source file if there is one. Deleting the existing
+        file is skipped anyways (see `delete_file`).
         """
-        while not self.task_queue.empty():
-            task_kwargs = self.task_queue.get()
-            handler_type = task_kwargs.pop('handler_type')
+        if prefixed_path in self.copied_files:
+            return self.log("Skipping '%s' (already copied earlier)" % path)
 
-            if handler_type == 'link':
-                super(Command, self).link_file(**task_kwargs)
-            else:
-                super(Command, self).copy_file(**task_kwargs)
+        source_path = source_storage.path(path)
+        if self.dry_run:
+            self.log("Pretending to copy '%s'" % source_path, level=1)
+        else:
+            self.log("Copying '%s'" % source_path, level=2)
+            with ContentFile(compressed) if compressed is not None else source_storage.open(path) as source_file:
+                source_file.content_type = content_type
+                source_file.content_encoding = content_encoding
+                self.storage.save(prefixed_path, source_file)
+        self.copied_files.append(prefixed_path)
+
+    def compress_file(self, path, source_storage):
+        """ Gzip the content of the source file for `--precompress` """
+        with source_storage.open(path) as source_file:
+            return gzip.compress(source_file.read(), compresslevel=6, mtime=0)
+
+    def is_unmodified(self, path, prefixed_path, source_storage, compressed=None):
+        """
+        Compare the MD5 checksum of the local file (or of its precompressed content) with the preloaded ETag of the
+        remote file. This only works for files which were uploaded in a single part, because the ETag of a multipart
+        upload isn't a checksum of its content.
+        """
+        remote_file = self.get_remote_file(prefixed_path)
+        if remote_file is None or '-' in remote_file.etag:
+            return False
+
+        if compressed is not None:
+            return hashlib.md5(compressed).hexdigest() == remote_file.etag
+
+        md5 = hashlib.md5()
+        with source_storage.open(path) as source_file:
+            for chunk in source_file.chunks():
+                md5.update(chunk)
+        return md5.hexdigest() == remote_file.etag
+
+    def is_up_to_date(self, path, prefixed_path, source_storage):
+        """
+        Compare the size and modification time of the local file with the preloaded remote file. This only needs a
+        `stat` of the local file, so it is cheap enough to be done before queueing the task.
+        """
+        remote_file = self.get_remote_file(prefixed_path)
+        if remote_file is None:
+            return False
+
+        try:
+            stat = os.stat(source_storage.path(path))
+        except NotImplementedError:
+            # The source storage isn't on the local file system
+            return False
+        return stat.st_size == remote_file.size and \
+            remote_file.last_modified >= datetime.fromtimestamp(stat.st_mtime, timezone.utc)
 
-            self.task_queue.task_done()
+    def get_remote_file(self, prefixed_path):
+        if hasattr(self.storage, 'get_remote_file'):
+            return self.storage.get_remote_file(prefixed_path)
+        return None
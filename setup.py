@@ -52,12 +52,17 @@ setup(
         'collectfaster',
     ],
     include_package_data=True,
+    python_requires='>=3.8',
     install_requires=[
         'django>=1.6',
-        'django-storages>=1.5.0',
+        'django-storages>=1.14',
+        'boto3>=1.25.0',
         'gevent>=1.1.1',
         'greenlet>=0.4.9',
     ],
+    extras_require={
+        'crt': ['botocore[crt]'],
+    },
     license="BSD",
     zip_safe=False,
     keywords='django-collectfaster',
@@ -69,11 +74,11 @@ setup(
         'Intended Audience :: Developers',
         'License :: OSI Approved :: BSD License',
         'Natural Language :: English',
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12',
     ],
 )